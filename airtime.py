@@ -0,0 +1,412 @@
+"""Airtime delivery through the telco provider's HTTP API.
+
+``recharge()`` debits the user and stores an ``AirtimePurchase`` as
+``pending``; ``queue_purchase()`` hands it to a background thread that
+sends queued top-ups to the provider in bulk calls, so a request never
+waits on the telco.
+
+Calls go through one pooled keep-alive session with strict timeouts, a
+circuit breaker that stops calling a failing provider for a while, and a
+bulkhead that caps concurrent calls per worker. Purchases whose outcome is
+unknown (timeouts, crashes) are settled by ``flask airtime reconcile``,
+meant to run from cron or as its own process with ``--loop``.
+
+Point AIRTIME_API_URL at ``python airtime_stub.py`` to try it locally.
+"""
+from datetime import datetime, timedelta
+import logging
+import queue
+import threading
+import time
+
+import click
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import update
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.retry import Retry
+
+from app import app, db, AirtimePurchase, Transaction, User
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """The provider call failed after it may have reached the provider."""
+
+
+class ProviderUnavailable(ProviderError):
+    """The call was not attempted: the breaker is open or the bulkhead is full."""
+
+
+class ProviderRejected(ProviderError):
+    """The provider refused the request (4xx), sending it again won't help."""
+
+
+class CircuitBreaker:
+    # closed: calls go through, open: calls are refused until reset_timeout
+    # has passed, half_open: a single trial call decides which way to go
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return
+            raise ProviderUnavailable(f'circuit breaker is {self.state}')
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning('Airtime provider circuit opened after %s failures', self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+class Bulkhead:
+    # Caps concurrent provider calls so a slow telco can't tie up every thread
+
+    def __init__(self, max_concurrent=4, acquire_timeout=0.1):
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.acquire_timeout = acquire_timeout
+
+    def __enter__(self):
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            raise ProviderUnavailable('too many concurrent provider calls')
+        return self
+
+    def __exit__(self, *exc):
+        self._semaphore.release()
+
+
+class AirtimeClient:
+
+    def __init__(self, base_url, api_key=None, connect_timeout=2, read_timeout=5, pool_size=10,
+                 max_concurrent=4, failure_threshold=5, reset_timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.bulkhead = Bulkhead(max_concurrent)
+
+        # One keep-alive session for every call; only connection errors are retried,
+        # anything later may have reached the provider and is left to reconciliation
+        self.session = requests.Session()
+        retry = Retry(total=1, connect=1, read=0, status=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def _post(self, path, payload):
+        # Bulkhead first: once the breaker lets a half-open trial through, the call
+        # has to be made so its outcome closes or reopens the breaker
+        with self.bulkhead:
+            self.breaker.before_call()
+            try:
+                response = self.session.post(self.base_url + path, json=payload, timeout=self.timeout)
+            except requests.RequestException as exc:
+                self.breaker.record_failure()
+                if _never_sent(exc):
+                    raise ProviderUnavailable(str(exc)) from exc
+                raise ProviderError(str(exc)) from exc
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise ProviderError(f'provider returned {response.status_code}')
+
+        if 400 <= response.status_code < 500:
+            # A 4xx is our fault, the provider itself is healthy
+            self.breaker.record_success()
+            raise ProviderRejected(f'provider rejected the request: {response.status_code} {response.text[:200]}')
+
+        try:
+            results = response.json()['results']
+            if not all(isinstance(result, dict) and 'reference' in result and 'status' in result
+                       for result in results):
+                raise ValueError('result without reference or status')
+        except (ValueError, KeyError, TypeError) as exc:
+            self.breaker.record_failure()
+            raise ProviderError(f'malformed provider response: {exc}') from exc
+
+        self.breaker.record_success()
+        return results
+
+    def bulk_topup(self, purchases):
+        return self._post('/topups/bulk', {'topups': [
+            {'reference': purchase.reference, 'phone_number': purchase.phone_number, 'amount': purchase.amount}
+            for purchase in purchases
+        ]})
+
+    def status(self, references):
+        return self._post('/topups/status', {'references': list(references)})
+
+
+def _never_sent(exc):
+    # Only a failure to connect proves the request never reached the provider
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(exc, requests.ConnectionError) and isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AirtimeClient(
+                app.config['AIRTIME_API_URL'],
+                api_key=app.config['AIRTIME_API_KEY'],
+                connect_timeout=app.config['AIRTIME_CONNECT_TIMEOUT'],
+                read_timeout=app.config['AIRTIME_READ_TIMEOUT'],
+                pool_size=app.config['AIRTIME_POOL_SIZE'],
+                max_concurrent=app.config['AIRTIME_MAX_CONCURRENT'],
+                failure_threshold=app.config['AIRTIME_BREAKER_FAILURES'],
+                reset_timeout=app.config['AIRTIME_BREAKER_RESET'],
+            )
+        return _client
+
+
+# settling purchases
+
+def _refund(purchase):
+    # The provider declined the top-up, give the user their money back. The
+    # balance is changed in SQL so a transfer committing at the same time isn't overwritten
+    refund = -purchase.transaction.amount
+    db.session.execute(
+        update(User).where(User.id == purchase.user_id).values(balance=User.balance + refund)
+    )
+    db.session.add(Transaction(
+        user_id=purchase.user_id,
+        recipient_name=purchase.user.full_name,
+        recipient_card_number=purchase.user.card_number,
+        amount=refund,
+        type='Credit - Airtime Refund'
+    ))
+
+
+def _leave_submitted(purchase, status, **values):
+    # A conditional UPDATE rather than the loaded status, so when two reconcilers
+    # look at the same purchase only one of them moves it on (and refunds it)
+    return db.session.execute(
+        update(AirtimePurchase)
+        .where(AirtimePurchase.id == purchase.id, AirtimePurchase.status == 'submitted')
+        .values(status=status, **values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def _fail(purchase):
+    if not _leave_submitted(purchase, 'failed'):
+        return 0
+    _refund(purchase)
+    return 1
+
+
+def _apply_results(purchases, results):
+    # Returns how many purchases ended up delivered or failed
+    by_reference = {purchase.reference: purchase for purchase in purchases}
+    settled = 0
+
+    for result in results:
+        purchase = by_reference.get(result['reference'])
+        if purchase is None:
+            continue
+
+        if result['status'] == 'delivered':
+            settled += _leave_submitted(purchase, 'delivered', provider_reference=result.get('provider_reference'))
+        elif result['status'] == 'failed':
+            settled += _fail(purchase)
+        # Anything else is still in flight at the provider, leave it submitted
+
+    db.session.commit()
+    return settled
+
+
+def deliver(purchase_ids):
+    """Send the given pending purchases to the provider in one bulk call.
+
+    Returns how many of them were delivered or failed.
+    """
+    purchases = AirtimePurchase.query.filter(
+        AirtimePurchase.id.in_(purchase_ids), AirtimePurchase.status == 'pending'
+    ).with_for_update(skip_locked=True).all()
+    if not purchases:
+        return 0
+
+    # Mark them first, so a crash mid-call leaves them for reconciliation rather than resending blindly
+    for purchase in purchases:
+        purchase.status = 'submitted'
+        purchase.attempts += 1
+    db.session.commit()
+
+    try:
+        results = get_client().bulk_topup(purchases)
+    except ProviderUnavailable as exc:
+        # Never sent, put them back in the queue for the next attempt
+        logger.warning('Airtime delivery postponed for %s purchases: %s', len(purchases), exc)
+        for purchase in purchases:
+            purchase.status = 'pending'
+            purchase.attempts -= 1
+        db.session.commit()
+        return 0
+    except ProviderRejected as exc:
+        if len(purchases) > 1:
+            # One bad top-up fails the whole call, send them one at a time to find it
+            logger.warning('Airtime bulk delivery of %s purchases rejected, retrying singly: %s', len(purchases), exc)
+            for purchase in purchases:
+                purchase.status = 'pending'
+                purchase.attempts -= 1
+            db.session.commit()
+            return sum(deliver([purchase.id]) for purchase in purchases)
+
+        logger.warning('Airtime purchase %s rejected, refunding: %s', purchases[0].id, exc)
+        settled = _fail(purchases[0])
+        db.session.commit()
+        return settled
+    except ProviderError as exc:
+        logger.warning('Airtime delivery outcome unknown for %s purchases: %s', len(purchases), exc)
+        return 0
+
+    return _apply_results(purchases, results)
+
+
+def reconcile(stale_after=60, batch_size=None):
+    """Settle purchases that were never sent or whose outcome is unknown.
+
+    Returns how many purchases ended up delivered or failed.
+    """
+    batch_size = batch_size or app.config['AIRTIME_BATCH_SIZE']
+    max_attempts = app.config['AIRTIME_MAX_ATTEMPTS']
+    cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+    settled = 0
+
+    # Submitted but unanswered: ask the provider what happened
+    submitted = AirtimePurchase.query.filter(
+        AirtimePurchase.status == 'submitted', AirtimePurchase.updated_at < cutoff
+    ).order_by(AirtimePurchase.id).limit(batch_size).all()
+    if submitted:
+        try:
+            results = get_client().status(purchase.reference for purchase in submitted)
+        except ProviderError as exc:
+            logger.warning('Airtime status check failed: %s', exc)
+        else:
+            unknown = {result['reference'] for result in results if result['status'] == 'unknown'}
+            settled += _apply_results(submitted, results)
+
+            # The provider never saw these, so sending them again is safe, up to a point
+            for purchase in submitted:
+                if purchase.reference not in unknown:
+                    continue
+                if purchase.attempts >= max_attempts:
+                    logger.warning('Airtime purchase %s not delivered after %s attempts, refunding',
+                                   purchase.id, purchase.attempts)
+                    settled += _fail(purchase)
+                else:
+                    _leave_submitted(purchase, 'pending')
+            db.session.commit()
+
+    # Pending ones the worker that took the request never got to
+    pending = db.session.execute(
+        db.select(AirtimePurchase.id)
+        .where(AirtimePurchase.status == 'pending', AirtimePurchase.created_at < cutoff)
+        .order_by(AirtimePurchase.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if pending:
+        settled += deliver(pending)
+
+    return settled
+
+
+# background batching
+
+_queue = queue.Queue()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_forever():
+    batch_size = app.config['AIRTIME_BATCH_SIZE']
+    interval = app.config['AIRTIME_FLUSH_INTERVAL']
+
+    while True:
+        # Wait for one purchase, then give others a short window to join the batch
+        batch = [_queue.get()]
+        deadline = time.monotonic() + interval
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        with app.app_context():
+            try:
+                deliver(batch)
+            except Exception:
+                # Left pending or submitted, reconciliation picks them up
+                logger.exception('Airtime delivery failed for purchases %s', batch)
+                db.session.rollback()
+
+
+def queue_purchase(purchase_id):
+    """Queue a pending purchase for the next bulk delivery from this process."""
+    global _flusher
+    with _flusher_lock:
+        # Started lazily so each gunicorn worker gets its own thread after forking
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_forever, name='airtime-flusher', daemon=True)
+            _flusher.start()
+    _queue.put(purchase_id)
+
+
+# CLI
+
+@app.cli.group('airtime')
+def airtime_cli():
+    """Airtime provider maintenance."""
+
+
+@airtime_cli.command('reconcile')
+@click.option('--stale-after', default=60, show_default=True, help='Seconds before a purchase is looked at.')
+@click.option('--loop', 'interval', default=0, help='Keep running, reconciling every N seconds.')
+def reconcile_command(stale_after, interval):
+    """Deliver or settle pending airtime purchases."""
+    while True:
+        try:
+            settled = reconcile(stale_after)
+            click.echo(f'{settled} airtime purchases delivered or refunded.')
+        except Exception:
+            logger.exception('Airtime reconciliation failed')
+            db.session.rollback()
+            if not interval:
+                raise
+
+        if not interval:
+            return
+        db.session.remove()
+        time.sleep(interval)
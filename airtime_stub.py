@@ -0,0 +1,77 @@
+# airtime_stub.py
+# Local stand-in for the telco airtime API, for trying out airtime.py.
+#
+#   AIRTIME_STUB_LATENCY=0.2 AIRTIME_STUB_FAILURE_RATE=0.1 python airtime_stub.py
+#
+# AIRTIME_STUB_LATENCY       seconds added to every request
+# AIRTIME_STUB_JITTER        extra random latency, up to this many seconds
+# AIRTIME_STUB_FAILURE_RATE  share of requests answered with a 503
+# AIRTIME_STUB_TIMEOUT_RATE  share of requests that hang for 30s, to trip client timeouts
+# AIRTIME_STUB_DECLINE_RATE  share of individual top-ups reported as failed
+#
+# Like the real API, a bulk call with any invalid top-up is rejected whole with a 422.
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from flask import Flask, abort, jsonify, request
+
+
+LATENCY = float(os.environ.get("AIRTIME_STUB_LATENCY", 0))
+JITTER = float(os.environ.get("AIRTIME_STUB_JITTER", 0))
+FAILURE_RATE = float(os.environ.get("AIRTIME_STUB_FAILURE_RATE", 0))
+TIMEOUT_RATE = float(os.environ.get("AIRTIME_STUB_TIMEOUT_RATE", 0))
+DECLINE_RATE = float(os.environ.get("AIRTIME_STUB_DECLINE_RATE", 0))
+
+stub = Flask(__name__)
+
+# reference -> result, so repeated references are idempotent and status lookups work
+results = {}
+results_lock = threading.Lock()
+
+
+@stub.before_request
+def simulate_network():
+    time.sleep(LATENCY + random.uniform(0, JITTER))
+
+    if random.random() < TIMEOUT_RATE:
+        time.sleep(30)
+    if random.random() < FAILURE_RATE:
+        abort(503)
+
+
+@stub.route('/topups/bulk', methods=['POST'])
+def bulk_topup():
+    for topup in request.json['topups']:
+        if not re.fullmatch(r'\+?\d{10,15}', str(topup.get('phone_number'))) or not topup.get('amount', 0) > 0:
+            return jsonify(error=f"invalid top-up {topup.get('reference')}"), 422
+
+    response = []
+    with results_lock:
+        for topup in request.json['topups']:
+            if topup['reference'] not in results:
+                declined = random.random() < DECLINE_RATE
+                results[topup['reference']] = {
+                    'reference': topup['reference'],
+                    'status': 'failed' if declined else 'delivered',
+                    'provider_reference': None if declined else uuid.uuid4().hex,
+                }
+            response.append(results[topup['reference']])
+    return jsonify(results=response)
+
+
+@stub.route('/topups/status', methods=['POST'])
+def topup_status():
+    with results_lock:
+        response = [
+            results.get(reference, {'reference': reference, 'status': 'unknown'})
+            for reference in request.json['references']
+        ]
+    return jsonify(results=response)
+
+
+if __name__ == '__main__':
+    stub.run(port=int(os.environ.get("AIRTIME_STUB_PORT", 5001)), threaded=True)
@@ -3,12 +3,17 @@ from flask_mail import Mail, Message
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import NamedTuple
+from sqlalchemy import select, String
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 import os
 from werkzeug.security import generate_password_hash, check_password_hash
 import random
 from flask_bcrypt import Bcrypt
 import re
+import uuid
 import pdfkit
 from urllib.parse import urlencode
 import requests
@@ -28,6 +33,13 @@ app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
 # db connection
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DB_URI')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Async (gevent) workers run WORKER_CONNECTIONS requests at once, each needing its own connection
+if os.environ.get("WORKER_MODE") == 'async' and not (app.config['SQLALCHEMY_DATABASE_URI'] or '').startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get("SQLALCHEMY_POOL_SIZE", os.environ.get("WORKER_CONNECTIONS", 100))),
+        'max_overflow': int(os.environ.get("SQLALCHEMY_MAX_OVERFLOW", 10)),
+        'pool_pre_ping': True,
+    }
 
 
 db = SQLAlchemy(app)
@@ -45,6 +57,20 @@ app.config['MAIL_PASSWORD'] = os.environ.get("MAIL_PASSWORD")
 mail = Mail(app)
 
 
+# airtime provider
+app.config['AIRTIME_API_URL'] = os.environ.get("AIRTIME_API_URL", "http://127.0.0.1:5001")
+app.config['AIRTIME_API_KEY'] = os.environ.get("AIRTIME_API_KEY")
+app.config['AIRTIME_CONNECT_TIMEOUT'] = float(os.environ.get("AIRTIME_CONNECT_TIMEOUT", 2))
+app.config['AIRTIME_READ_TIMEOUT'] = float(os.environ.get("AIRTIME_READ_TIMEOUT", 5))
+app.config['AIRTIME_POOL_SIZE'] = int(os.environ.get("AIRTIME_POOL_SIZE", 10))
+app.config['AIRTIME_MAX_CONCURRENT'] = int(os.environ.get("AIRTIME_MAX_CONCURRENT", 4))  # bulkhead size per worker
+app.config['AIRTIME_BREAKER_FAILURES'] = int(os.environ.get("AIRTIME_BREAKER_FAILURES", 5))
+app.config['AIRTIME_BREAKER_RESET'] = float(os.environ.get("AIRTIME_BREAKER_RESET", 30))
+app.config['AIRTIME_MAX_ATTEMPTS'] = int(os.environ.get("AIRTIME_MAX_ATTEMPTS", 5))  # sends before a purchase is refunded
+app.config['AIRTIME_BATCH_SIZE'] = int(os.environ.get("AIRTIME_BATCH_SIZE", 50))
+app.config['AIRTIME_FLUSH_INTERVAL'] = float(os.environ.get("AIRTIME_FLUSH_INTERVAL", 0.5))
+
+
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -55,6 +81,23 @@ class User(db.Model):
     balance = db.Column(db.Float, default=50000.00)
 
 
+class fold_case(FunctionElement):
+    # lower() on PostgreSQL, whose LIKE is case-sensitive; MySQL's collations and
+    # SQLite's LIKE already ignore case, so there the column is used as it is
+    type = String()
+    inherit_cache = True
+
+
+@compiles(fold_case)
+def _fold_case(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(fold_case, 'postgresql')
+def _fold_case_postgresql(element, compiler, **kw):
+    return 'lower(%s)' % compiler.process(element.clauses, **kw)
+
+
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -66,12 +109,134 @@ class Transaction(db.Model):
 
     user = db.relationship('User', backref='transactions')
 
+    # Indexes backing the transaction history search, see migration 5b1d2c7e9a40
+    __table_args__ = (
+        db.Index('ix_transaction_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_transaction_user_id_type_timestamp', 'user_id', 'type', 'timestamp'),
+        db.Index('ix_transaction_user_id_recipient_card_number', 'user_id', 'recipient_card_number'),
+        db.Index('ix_transaction_user_id_recipient_name', 'user_id', fold_case(recipient_name).label('recipient_name'),
+                 postgresql_ops={'recipient_name': 'text_pattern_ops'}),
+    )
+
     def __repr__(self):
         return f"Transaction(id={self.id}, user_id={self.user_id}, recipient_name={self.recipient_name}, " \
                f"recipient_card_number={self.recipient_card_number}, amount={self.amount}, " \
                f"type={self.type}, timestamp={self.timestamp})"
 
 
+# Every value the routes write to Transaction.type
+TRANSACTION_TYPES = ['Debit', 'Credit', 'Credit - Deposit', 'Debit - Airtime Purchase', 'Credit - Airtime Refund']
+
+
+class AirtimePurchase(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transaction.id'))
+    phone_number = db.Column(db.String(20))
+    amount = db.Column(db.Float)  # Face value sent to the provider, before our discount
+    reference = db.Column(db.String(36), unique=True)  # Idempotency key shared with the provider
+    provider_reference = db.Column(db.String(64))
+    status = db.Column(db.String(10), default='pending', index=True)  # pending, submitted, delivered, failed
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    user = db.relationship('User')
+    transaction = db.relationship('Transaction')
+
+
+# read models
+# List views only need a few columns, so they skip the ORM (identity map,
+# lazy relationships, attribute instrumentation) and get plain tuples back.
+
+class TransactionRow(NamedTuple):
+    type: str
+    timestamp: datetime
+    amount: float
+    recipient_card_number: str
+
+
+class TransactionSearch(NamedTuple):
+    name: str = None
+    card_number: str = None
+    type: str = None
+    min_amount: float = None
+    max_amount: float = None
+    date_from: datetime = None
+    date_to: datetime = None
+
+    @classmethod
+    def from_args(cls, args):
+        # Build the search from query string parameters, ignoring empty or malformed values
+        def parse(key, convert):
+            value = args.get(key, '').strip()
+            if not value:
+                return None
+            try:
+                return convert(value)
+            except ValueError:
+                return None
+
+        return cls(
+            name=parse('name', str),
+            card_number=parse('card_number', lambda value: re.sub(r'[\s-]', '', value)),
+            type=parse('type', str),
+            min_amount=parse('min_amount', float),
+            max_amount=parse('max_amount', float),
+            date_from=parse('date_from', datetime.fromisoformat),
+            date_to=parse('date_to', datetime.fromisoformat),
+        )
+
+    def filters(self, table):
+        # Name, card number, type and dates follow user_id in one of the composite
+        # indexes; the amount range is only checked on the rows those narrow down to
+        if self.name:
+            # Case-insensitive prefix match only, a leading wildcard could not use the
+            # index. The pattern is built here so it reaches the database as a literal 'prefix%'
+            escaped = re.sub(r'([/%_])', r'/\1', self.name)
+            yield fold_case(table.c.recipient_name).like(fold_case(escaped + '%'), escape='/')
+        if self.card_number:
+            yield table.c.recipient_card_number == self.card_number
+        if self.type:
+            yield table.c.type == self.type
+        if self.min_amount is not None:
+            yield table.c.amount >= self.min_amount
+        if self.max_amount is not None:
+            yield table.c.amount <= self.max_amount
+        if self.date_from:
+            yield table.c.timestamp >= self.date_from
+        if self.date_to:
+            # The end date is inclusive, so match anything before the next midnight
+            yield table.c.timestamp < self.date_to + timedelta(days=1)
+
+
+def transaction_rows_query(user_id, search=None):
+    # Select just the columns the history table shows, newest first
+    table = Transaction.__table__
+    query = (
+        select(table.c.type, table.c.timestamp, table.c.amount, table.c.recipient_card_number)
+        .where(table.c.user_id == user_id)
+        .order_by(table.c.timestamp.desc(), table.c.id.desc())
+    )
+    if search is not None:
+        query = query.where(*search.filters(table))
+    return query
+
+
+def transaction_rows(user_id, search=None, page=1, per_page=None):
+    query = transaction_rows_query(user_id, search)
+    if per_page is None:
+        return [TransactionRow(*row) for row in db.session.execute(query)], False
+
+    # Fetch one extra row to find out whether there is a next page
+    query = query.limit(per_page + 1).offset((page - 1) * per_page)
+    rows = [TransactionRow(*row) for row in db.session.execute(query)]
+    return rows[:per_page], len(rows) > per_page
+
+
+TRANSACTIONS_PER_PAGE = 50
+
+
 # 
 
 def insert_hyphens(value):
@@ -238,11 +403,11 @@ def transfer():
                     flash('Cannot send funds to yourself.', 'danger')
                     return redirect(url_for('transfer'))
 
-                # Update sender's balance
-                user.balance -= amount
+                # Update sender's balance (in SQL, so a concurrent airtime refund isn't overwritten)
+                user.balance = User.balance - amount
 
                 # Update recipient's balance
-                recipient.balance += amount
+                recipient.balance = User.balance + amount
 
                 # Update the database
                 db.session.commit()
@@ -322,7 +487,7 @@ def deposit():
                 return redirect(url_for('deposit'))
 
             # Update the user's balance
-            user.balance += amount
+            user.balance = User.balance + amount
 
             # Create a credit transaction record
             transaction = Transaction(
@@ -356,8 +521,17 @@ def recharge():
         user = User.query.get(user_id)
 
         if request.method == 'POST':
+            phone_number = re.sub(r'[^\d+]', '', request.form['card_number'])
             amount = float(request.form['amount'])
 
+            # Check the top-up is one the provider will accept before taking any money
+            if not re.fullmatch(r'\+?\d{10,15}', phone_number):
+                flash('Invalid phone number.', 'danger')
+                return redirect(url_for('recharge'))
+            if amount <= 0:
+                flash('Invalid amount.', 'danger')
+                return redirect(url_for('recharge'))
+
             # Calculate the discount amount (10% of the recharge amount)
             discount = amount * 0.1
             total_amount = amount - discount
@@ -367,11 +541,8 @@ def recharge():
                 flash('Insufficient balance.', 'danger')
                 return redirect(url_for('recharge'))
 
-            # Update the user's balance
-            user.balance -= total_amount
-
-            # Update the database
-            db.session.commit()
+            # Update the user's balance, committed together with the records below
+            user.balance = User.balance - total_amount
 
             # Create a new transaction record for the recharge
             transaction = Transaction(
@@ -382,8 +553,20 @@ def recharge():
                 type='Debit - Airtime Purchase'  # Transaction type is 'Debit' for a purchase
             )
             db.session.add(transaction)
+
+            # Record the top-up for the provider, it is delivered in the background
+            purchase = AirtimePurchase(
+                user=user,
+                transaction=transaction,
+                phone_number=phone_number,
+                amount=amount,
+                reference=str(uuid.uuid4())
+            )
+            db.session.add(purchase)
             db.session.commit()
 
+            airtime.queue_purchase(purchase.id)
+
             return render_template('recharge_success.html', amount=total_amount, discount=discount)
 
         return render_template('recharge.html', user=user)
@@ -403,10 +586,17 @@ def transaction_history():
         # Retrieve the user from the database using user_id
         user = User.query.get(user_id)
 
-        # Retrieve the user's transactions in descending order of timestamp
-        transactions = Transaction.query.filter_by(user_id=user_id).order_by(Transaction.timestamp.desc()).all()
+        # Retrieve the user's transactions matching the search, one page at a time
+        search = TransactionSearch.from_args(request.args)
+        page = max(request.args.get('page', 1, type=int), 1)
+        transactions, has_next = transaction_rows(user_id, search, page, TRANSACTIONS_PER_PAGE)
 
-        return render_template('transaction_history.html', user=user, transactions=transactions)
+        # Keep the search terms in the pagination links
+        search_args = {key: value for key, value in request.args.items() if key != 'page' and value}
+
+        return render_template('transaction_history.html', user=user, transactions=transactions,
+                               search=search, search_args=search_args, page=page, has_next=has_next,
+                               transaction_types=TRANSACTION_TYPES)
     
     else:
         flash('You need to log in first.', 'danger')
@@ -562,3 +752,9 @@ def generate_receipt(receipt_data):
 
     # Return the filename so it can be used for downloading
     return filename
+
+
+# bulk import/export CLI commands (flask bulk ...) and the airtime provider integration,
+# imported last since both modules import from this one
+import bulk
+import airtime
@@ -0,0 +1,98 @@
+# history_render.py
+# Compares rendering transaction_history.html from full ORM objects against
+# the column-only TransactionRow read path, on a throwaway SQLite database.
+#
+#   python benchmarks/history_render.py --rows 100000 --repeat 3
+#
+# Reports wall time, CPU time and peak Python memory (tracemalloc) for
+# fetching the rows and rendering the whole table in one go.
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def orm_rows(Transaction, user_id):
+    # The read path transaction_history() used before TransactionRow
+    return Transaction.query.filter_by(user_id=user_id).order_by(Transaction.timestamp.desc()).all()
+
+
+def measure(fetch, render):
+    started, cpu_started = time.perf_counter(), time.process_time()
+    rows = fetch()
+    html = render(rows)
+    return len(rows), len(html), time.perf_counter() - started, time.process_time() - cpu_started
+
+
+def peak_memory(fetch, render):
+    # Separate pass, tracemalloc slows everything down too much to time with it on
+    tracemalloc.start()
+    render(fetch())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the transaction history render paths.')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ['DB_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    from flask import render_template
+    from app import app, db, User, Transaction, TransactionSearch, TRANSACTION_TYPES, transaction_rows
+
+    with app.app_context():
+        db.create_all()
+        # One user owns every generated transaction
+        result = app.test_cli_runner().invoke(
+            args=['bulk', 'generate', '--users', '1', '--transactions', str(args.rows), '--seed', '1',
+                  '--defer-indexes']
+        )
+        if result.exit_code != 0:
+            sys.exit(result.output)
+        user = User.query.first()
+        user_id = user.id
+
+        def render(rows):
+            return render_template('transaction_history.html', user=user, transactions=rows,
+                                   search=TransactionSearch(), search_args={}, page=1, has_next=False,
+                                   transaction_types=TRANSACTION_TYPES)
+
+        def reset():
+            # Start every run with an empty identity map
+            db.session.expunge_all()
+            db.session.add(user)
+
+        paths = {
+            'orm': lambda: orm_rows(Transaction, user_id),
+            'core': lambda: transaction_rows(user_id)[0],
+        }
+
+        print(f'{"path":<6} {"rows":>8} {"wall s":>8} {"cpu s":>8} {"peak MiB":>9}')
+        for name, fetch in paths.items():
+            best = None
+            for _ in range(args.repeat):
+                with app.test_request_context('/transaction_history'):
+                    run = measure(fetch, render)
+                reset()
+                if best is None or run[2] < best[2]:
+                    best = run
+
+            with app.test_request_context('/transaction_history'):
+                peak = peak_memory(fetch, render)
+            reset()
+
+            rows, _, wall, cpu = best
+            print(f'{name:<6} {rows:>8} {wall:>8.3f} {cpu:>8.3f} {peak / 2**20:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# worker_modes.py
+# Compares sync and async (gevent) gunicorn workers on a request that waits
+# on I/O: one database query plus one call to airtime_stub.py, which holds
+# every call for AIRTIME_STUB_LATENCY seconds.
+#
+#   python benchmarks/worker_modes.py --latency 0.2 --concurrency 100
+#
+# Reports requests/sec, median latency, and peak RSS of the gunicorn
+# processes in total and per concurrent connection.
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PROBE = '/_bench/provider'
+
+if os.environ.get('WORKER_MODE_BENCH'):
+    # Imported by the gunicorn workers started below: the app plus a route
+    # that waits on the provider while the request is in flight
+    from app import app, db, User
+    import airtime
+
+    @app.route(PROBE)
+    def provider_probe():
+        User.query.first()
+        # Hand the connection back first, app.py leaves SQLite on the default 5 + 10 pool
+        db.session.remove()
+        airtime.get_client().status([str(uuid.uuid4())])
+        return 'ok'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f'{url} exited with {process.returncode}')
+        try:
+            requests.get(url, timeout=5)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    sys.exit(f'{url} did not come up')
+
+
+def rss(pid):
+    # Resident memory of a process and all its children, in bytes
+    total = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/status') as status:
+                fields = dict(line.split(':', 1) for line in status)
+        except OSError:
+            continue
+        if int(entry) == pid or int(fields['PPid']) == pid:
+            total += int(fields.get('VmRSS', '0 kB').split()[0]) * 1024
+    return total
+
+
+def drive(url, concurrency, duration):
+    latencies, errors = [], []
+    started = time.monotonic()
+    stop = started + duration
+
+    def client():
+        session = requests.Session()
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                session.get(url, timeout=30).raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except requests.RequestException as exc:
+                errors.append(exc)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Includes the requests still in flight at the stop time
+    return latencies, errors, time.monotonic() - started
+
+
+def run(mode, workers, args, env):
+    port = free_port()
+    process = subprocess.Popen(
+        ['gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+         '--log-level', 'warning', 'benchmarks.worker_modes:app'],
+        cwd=ROOT, env=dict(env, WORKER_MODE=mode),
+    )
+    try:
+        url = f'http://127.0.0.1:{port}{PROBE}'
+        wait_until_up(url, process)
+
+        peak = rss(process.pid)
+        sampling = threading.Event()
+
+        def sample():
+            nonlocal peak
+            while not sampling.wait(0.5):
+                peak = max(peak, rss(process.pid))
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        latencies, errors, elapsed = drive(url, args.concurrency, args.duration)
+        sampling.set()
+        sampler.join()
+    finally:
+        process.terminate()
+        process.wait()
+
+    rate = len(latencies) / elapsed
+    median = statistics.median(latencies) if latencies else float('nan')
+    print(f'{mode:<6} {workers:>7} {rate:>9.1f} {median * 1000:>9.0f} {len(errors):>7} '
+          f'{peak / 2**20:>9.1f} {peak / args.concurrency / 2**20:>9.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sync against async gunicorn workers.')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the stub provider holds each call')
+    parser.add_argument('--concurrency', type=int, default=100, help='concurrent client connections')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per mode')
+    parser.add_argument('--sync-workers', type=int, default=4)
+    parser.add_argument('--async-workers', type=int, default=1)
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    env = dict(
+        os.environ,
+        WORKER_MODE_BENCH='1',
+        DB_URI='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'),
+        AIRTIME_API_URL=f'http://127.0.0.1:{stub_port}',
+        AIRTIME_STUB_PORT=str(stub_port),
+        AIRTIME_STUB_LATENCY=str(args.latency),
+        # Let every connection reach the provider, the bulkhead would cap async mode otherwise
+        AIRTIME_MAX_CONCURRENT=str(args.concurrency),
+        AIRTIME_POOL_SIZE=str(args.concurrency),
+        WORKER_CONNECTIONS=str(args.concurrency),
+    )
+    subprocess.run([sys.executable, '-c', 'from app import app, db\nwith app.app_context(): db.create_all()'],
+                   cwd=ROOT, env=env, check=True)
+
+    stub = subprocess.Popen([sys.executable, 'airtime_stub.py'], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(f'http://127.0.0.1:{stub_port}/', stub)
+
+        print(f'{args.concurrency} connections, {args.latency}s provider latency, {args.duration}s per mode')
+        print(f'{"mode":<6} {"workers":>7} {"req/s":>9} {"p50 ms":>9} {"errors":>7} {"peak MiB":>9} {"MiB/conn":>9}')
+        run('sync', args.sync_workers, args, env)
+        run('async', args.async_workers, args, env)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == '__main__':
+    main()
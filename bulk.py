@@ -0,0 +1,422 @@
+"""Bulk loading commands for staging, benchmarking and customer migrations.
+
+Registered on the app as ``flask bulk ...``:
+
+    flask bulk import-users users.csv
+    flask bulk import-transactions transactions.ndjson --batch-size 10000
+    flask bulk export transactions out.csv
+    flask bulk generate --users 1000 --transactions 10000000 --rate 50000
+"""
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import csv
+import io
+import itertools
+import json
+import random
+import sys
+import time
+
+import click
+from bcrypt import gensalt, hashpw
+from sqlalchemy import select
+
+from app import app, db, User, Transaction, TRANSACTION_TYPES
+
+
+USER_FIELDS = ['id', 'full_name', 'email', 'password', 'card_number', 'balance']
+TRANSACTION_FIELDS = ['id', 'user_id', 'recipient_name', 'recipient_card_number', 'amount', 'type', 'timestamp']
+
+@app.cli.group()
+def bulk():
+    """Bulk import, export and synthetic data generation."""
+
+
+# helpers
+
+def _read_rows(path, fmt):
+    # Stream rows from a CSV or NDJSON file (or stdin with '-') without loading it all
+    if fmt is None:
+        fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    handle = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        if fmt == 'csv':
+            for row in csv.DictReader(handle):
+                yield {key: value for key, value in row.items() if value != ''}
+        else:
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _hash_password(password, rounds):
+    # Runs in a worker process, so it uses bcrypt directly instead of the Flask extension
+    return hashpw(password.encode('utf-8'), gensalt(rounds)).decode('utf-8')
+
+
+def _is_hashed(password):
+    return password.startswith(('$2a$', '$2b$', '$2y$'))
+
+
+def _random_card_number():
+    return ''.join([str(random.randint(0, 9)) for _ in range(16)])
+
+
+@contextmanager
+def _deferred_foreign_keys(conn, enabled):
+    # MySQL checks every row's foreign keys on insert; callers that already
+    # validated the references in bulk can skip that. Unique checks always stay on.
+    # SQLite doesn't enforce foreign keys unless asked to and PostgreSQL
+    # can only defer them for constraints declared DEFERRABLE, which ours aren't.
+    mysql = enabled and conn.dialect.name in ('mysql', 'mariadb')
+    if mysql:
+        conn.exec_driver_sql('SET foreign_key_checks=0')
+    try:
+        yield
+    finally:
+        if mysql:
+            conn.exec_driver_sql('SET foreign_key_checks=1')
+
+
+def _deferrable_indexes(model, dialect):
+    # Non-unique indexes only, unique ones are what keeps the data consistent.
+    # InnoDB needs an index on every foreign key's columns and won't drop the
+    # last one, so on MySQL the smallest index covering each foreign key stays.
+    indexes = sorted((index for index in model.__table__.indexes if not index.unique),
+                     key=lambda index: (len(index.columns), index.name))
+    if dialect in ('mysql', 'mariadb'):
+        for foreign_key in model.__table__.foreign_key_constraints:
+            keys = list(foreign_key.column_keys)
+            for index in indexes:
+                if [column.key for column in index.columns][:len(keys)] == keys:
+                    indexes.remove(index)
+                    break
+    return indexes
+
+
+@contextmanager
+def _deferred_indexes(model, enabled):
+    # Maintaining secondary indexes row by row is what makes big loads slow on
+    # every backend, so drop them and rebuild each in one pass at the end.
+    # Only the ones actually dropped are rebuilt, even if a later drop fails.
+    indexes = _deferrable_indexes(model, db.engine.dialect.name) if enabled else []
+    dropped = []
+    try:
+        for index in indexes:
+            with db.engine.begin() as conn:
+                index.drop(conn, checkfirst=True)
+            dropped.append(index)
+        yield
+    finally:
+        for index in dropped:
+            click.echo(f'Rebuilding index {index.name}...', err=True)
+            with db.engine.begin() as conn:
+                index.create(conn, checkfirst=True)
+
+
+def _check_unique(model, column, values, what):
+    # Reject duplicates within the batch or against existing rows before inserting
+    repeated = {value for value, count in Counter(values).items() if count > 1}
+    existing = set(db.session.execute(
+        select(getattr(model, column)).where(getattr(model, column).in_(set(values)))
+    ).scalars())
+    clashes = sorted(repeated | existing)
+    if clashes:
+        raise click.ClickException(f'Duplicate {what}: {", ".join(clashes[:10])}'
+                                   + (f' and {len(clashes) - 10} more' if len(clashes) > 10 else ''))
+
+
+def _assign_card_numbers(batch):
+    # Generated card numbers must not clash with each other or with existing cards
+    taken = {row['card_number'] for row in batch if row.get('card_number')}
+    pending = [row for row in batch if not row.get('card_number')]
+
+    while pending:
+        for row in pending:
+            row['card_number'] = _random_card_number()
+        candidates = [row['card_number'] for row in pending]
+        clashes = set(db.session.execute(
+            select(User.card_number).where(User.card_number.in_(candidates))
+        ).scalars())
+        clashes |= {number for number, count in Counter(candidates).items() if count > 1} | taken
+
+        taken |= set(candidates) - clashes
+        pending = [row for row in pending if row['card_number'] in clashes]
+
+    return batch
+
+
+def _copy_rows(conn, table, fields, rows):
+    # PostgreSQL only: COPY is much faster than any INSERT form
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row.get(field) for field in fields])
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f'COPY "{table.name}" ({", ".join(fields)}) FROM STDIN WITH (FORMAT csv)', buffer
+    )
+
+
+def _insert_rows(conn, model, rows, use_copy):
+    table = model.__table__
+    fields = [col for col in table.columns.keys() if any(col in row for row in rows)]
+
+    if use_copy and conn.dialect.name == 'postgresql':
+        _copy_rows(conn, table, fields, rows)
+    else:
+        # executemany; the MySQL and PostgreSQL drivers turn this into multi-row INSERTs
+        conn.execute(table.insert(), [{field: row.get(field) for field in fields} for row in rows])
+
+
+def _load(model, rows, batch_size, use_copy, prepare=None, defer_indexes=False, defer_foreign_keys=False):
+    total = 0
+    started = time.monotonic()
+
+    with _deferred_indexes(model, defer_indexes), db.engine.connect() as conn:
+        with _deferred_foreign_keys(conn, defer_foreign_keys):
+            for batch in _batches(rows, batch_size):
+                if prepare is not None:
+                    batch = prepare(batch)
+
+                _insert_rows(conn, model, batch, use_copy)
+                conn.commit()
+
+                total += len(batch)
+                elapsed = time.monotonic() - started
+                click.echo(f'{total} rows loaded ({total / max(elapsed, 1e-6):.0f} rows/s)', err=True)
+
+    return total
+
+
+def _reset_sequence(model):
+    # Explicit ids were inserted, move the PostgreSQL sequence past them
+    if db.engine.dialect.name == 'postgresql':
+        table = model.__table__.name
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM \"{table}\"), 1))"
+            )
+
+
+# import
+
+@bulk.command('import-users')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--workers', default=None, type=int, help='Processes used for password hashing.')
+@click.option('--copy/--no-copy', 'use_copy', default=True, help='Use COPY on PostgreSQL.')
+def import_users(path, fmt, batch_size, workers, use_copy):
+    """Import users from a CSV or NDJSON file.
+
+    Plain-text passwords are bcrypt hashed in a process pool; values that
+    are already bcrypt hashes are stored as they are. The import stops at
+    the first batch containing an email or card number that is repeated or
+    already taken; earlier batches stay imported.
+    """
+    rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def prepare(batch):
+            if any(not row.get('email') for row in batch):
+                raise click.ClickException('Every user needs an email.')
+            _check_unique(User, 'email', [row['email'] for row in batch], 'emails')
+            _check_unique(User, 'card_number', [row['card_number'] for row in batch if row.get('card_number')],
+                          'card numbers')
+            _assign_card_numbers(batch)
+
+            plain = [i for i, row in enumerate(batch) if row.get('password') and not _is_hashed(row['password'])]
+            hashed = pool.map(_hash_password, [batch[i]['password'] for i in plain],
+                              itertools.repeat(rounds), chunksize=64)
+            for i, password in zip(plain, hashed):
+                batch[i]['password'] = password
+
+            for row in batch:
+                row.setdefault('balance', 50000.00)
+            return batch
+
+        total = _load(User, _read_rows(path, fmt), batch_size, use_copy, prepare)
+
+    _reset_sequence(User)
+    click.echo(f'Imported {total} users.')
+
+
+@bulk.command('import-transactions')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=10000, show_default=True)
+@click.option('--copy/--no-copy', 'use_copy', default=True, help='Use COPY on PostgreSQL.')
+@click.option('--defer-indexes/--keep-indexes', default=False, show_default=True,
+              help='Drop the non-unique indexes during the load and rebuild them at the end.')
+def import_transactions(path, fmt, batch_size, use_copy, defer_indexes):
+    """Import transactions from a CSV or NDJSON file.
+
+    Rows reference their owner by ``user_id`` or by ``user_email``. Owners
+    are checked to exist batch by batch, so MySQL can skip its per-row
+    foreign key checks.
+
+    ``--defer-indexes`` is faster on an empty table, but history searches
+    are slow until the load finishes and a killed load leaves the indexes
+    dropped, so only use it on a database nobody is using yet.
+    """
+    user_ids = {}
+    known_ids = set()
+
+    def prepare(batch):
+        # Resolve any emails in this batch with a single query
+        missing = {row['user_email'] for row in batch if 'user_id' not in row and row.get('user_email') not in user_ids}
+        if missing:
+            user_ids.update(db.session.execute(
+                select(User.email, User.id).where(User.email.in_(missing))
+            ).all())
+
+        for row in batch:
+            email = row.pop('user_email', None)
+            if 'user_id' not in row:
+                if email not in user_ids:
+                    raise click.ClickException(f'Unknown user email: {email}')
+                row['user_id'] = user_ids[email]
+            row['user_id'] = int(row['user_id'])
+            if isinstance(row.get('timestamp'), str):
+                row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            row.setdefault('timestamp', datetime.utcnow())
+
+        # Check the owners exist ourselves, in one query per batch
+        unchecked = {row['user_id'] for row in batch} - known_ids
+        if unchecked:
+            known_ids.update(db.session.execute(select(User.id).where(User.id.in_(unchecked))).scalars())
+            unknown = unchecked - known_ids
+            if unknown:
+                raise click.ClickException(f'Unknown user ids: {", ".join(map(str, sorted(unknown)[:10]))}')
+        return batch
+
+    total = _load(Transaction, _read_rows(path, fmt), batch_size, use_copy, prepare,
+                  defer_indexes=defer_indexes, defer_foreign_keys=True)
+
+    _reset_sequence(Transaction)
+    click.echo(f'Imported {total} transactions.')
+
+
+# export
+
+@bulk.command('export')
+@click.argument('what', type=click.Choice(['users', 'transactions']))
+@click.argument('path', default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv', show_default=True)
+@click.option('--batch-size', default=10000, show_default=True)
+def export(what, path, fmt, batch_size):
+    """Stream users or transactions to a CSV or NDJSON file."""
+    model, fields = (User, USER_FIELDS) if what == 'users' else (Transaction, TRANSACTION_FIELDS)
+    table = model.__table__
+
+    handle = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+    total = 0
+    try:
+        if fmt == 'csv':
+            writer = csv.writer(handle)
+            writer.writerow(fields)
+
+        # Server-side cursor, rows are fetched in batches instead of all at once
+        with db.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+                select(*(table.c[field] for field in fields)).order_by(table.c.id)
+            )
+            for partition in result.partitions():
+                for row in partition:
+                    if fmt == 'csv':
+                        writer.writerow(row)
+                    else:
+                        handle.write(json.dumps(dict(row._mapping), default=str) + '\n')
+                total += len(partition)
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+
+    click.echo(f'Exported {total} {what}.', err=True)
+
+
+# synthetic data
+
+@bulk.command('generate')
+@click.option('--users', 'user_count', default=0, help='Number of users to create first.')
+@click.option('--transactions', 'transaction_count', default=0, help='Number of transactions to create.')
+@click.option('--rate', default=0, help='Target rows per second, 0 for as fast as possible.')
+@click.option('--batch-size', default=10000, show_default=True)
+@click.option('--password', default='password', show_default=True, help='Password for every generated user.')
+@click.option('--seed', default=None, type=int)
+@click.option('--defer-indexes/--keep-indexes', default=False, show_default=True,
+              help='Drop the non-unique transaction indexes while generating.')
+def generate(user_count, transaction_count, rate, batch_size, password, seed, defer_indexes):
+    """Generate synthetic users and transactions.
+
+    Transactions are spread over existing users and the last year of
+    timestamps. With ``--rate`` the insert speed is throttled to roughly
+    that many rows per second, which is useful for load tests.
+    """
+    rng = random.Random(seed)
+
+    if user_count:
+        # Every generated user shares one hash, hashing millions of passwords is not the point here
+        hashed = _hash_password(password, app.config.get('BCRYPT_LOG_ROUNDS', 12))
+        start = int(time.time())
+        users = (
+            {
+                'full_name': f'User {i}',
+                'email': f'user{start}_{i}@example.com',
+                'password': hashed,
+                'balance': 50000.00,
+            }
+            for i in range(user_count)
+        )
+        _load(User, users, batch_size, use_copy=True, prepare=_assign_card_numbers)
+        click.echo(f'Generated {user_count} users.')
+
+    if not transaction_count:
+        return
+
+    people = db.session.execute(select(User.id, User.full_name, User.card_number)).all()
+    if not people:
+        raise click.ClickException('No users to attach transactions to, use --users.')
+
+    now = datetime.utcnow()
+    started = time.monotonic()
+
+    def transactions():
+        for i in range(transaction_count):
+            owner, other = rng.choice(people), rng.choice(people)
+            yield {
+                'user_id': owner.id,
+                'recipient_name': other.full_name,
+                'recipient_card_number': other.card_number,
+                'amount': round(rng.uniform(100, 100000), 2),
+                'type': rng.choice(TRANSACTION_TYPES),
+                'timestamp': now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+            }
+
+            # Throttle at batch boundaries so each batch goes out in one round trip
+            if rate and (i + 1) % batch_size == 0:
+                ahead = (i + 1) / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    _load(Transaction, transactions(), batch_size, use_copy=True, defer_indexes=defer_indexes)
+    click.echo(f'Generated {transaction_count} transactions.')
@@ -0,0 +1,41 @@
+# gunicorn.conf.py
+# Picked up automatically by gunicorn when started from this directory:
+#
+#   gunicorn app:app                      sync workers (default)
+#   WORKER_MODE=async gunicorn app:app    gevent workers for I/O-bound routes
+#
+# In async mode each worker serves many requests at once. gevent patches
+# sockets and subprocess, so SMTP in submit_form, wkhtmltopdf in
+# generate_receipt, PyMySQL queries and the airtime/rate HTTP calls all
+# yield to other requests while they wait instead of holding the worker.
+import os
+
+from dotenv import load_dotenv
+
+
+# Same .env the app reads, for DB_URI and WORKER_MODE
+load_dotenv()
+
+worker_mode = os.environ.get("WORKER_MODE", "sync")
+uses_postgres = os.environ.get("DB_URI", "").startswith("postgres")
+
+if worker_mode == "async":
+    worker_class = "gevent"
+    # Concurrent requests per worker, app.py sizes the database pool from it
+    worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 100))
+
+    # psycopg2 is a C extension gevent can't patch, without psycogreen every
+    # query would block all the requests a worker is serving
+    if uses_postgres:
+        try:
+            import psycogreen.gevent  # noqa: F401
+        except ImportError:
+            raise RuntimeError("WORKER_MODE=async with PostgreSQL needs psycogreen, pip install -r requirements.txt")
+elif worker_mode != "sync":
+    raise ValueError(f"WORKER_MODE must be 'sync' or 'async', not {worker_mode!r}")
+
+
+def post_fork(server, worker):
+    if worker_mode == "async" and uses_postgres:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
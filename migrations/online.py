@@ -0,0 +1,275 @@
+"""Helpers for online schema changes on large tables.
+
+``op.batch_alter_table()`` rebuilds the whole table and, on MySQL, holds a
+lock on it for the length of the copy. For big tables like ``transaction``
+the helpers below split a column change into steps that keep writes
+flowing:
+
+1. ``add_column()`` adds the new (nullable) column in place,
+2. ``sync_column()`` installs triggers so every write to the old column
+   also lands in the new one from now on,
+3. ``backfill()`` copies existing rows over in small primary-key chunks,
+   committing after every chunk and recording how far it got so an
+   interrupted run picks up where it stopped,
+4. ``cut_over()`` briefly locks the table, removes the triggers and swaps
+   the columns by renaming them.
+
+Usage from a revision file, here widening ``transaction.type``. The index
+on the old column has to go before the swap and is rebuilt afterwards::
+
+    from migrations import online
+
+    def upgrade():
+        online.add_column('transaction', sa.Column('type_new', sa.String(50)))
+        online.sync_column('transaction', 'type', 'type_new')
+        online.backfill('transaction', {'type_new': sa.column('type')},
+                        name='widen_transaction_type')
+        op.drop_index('ix_transaction_user_id_type_timestamp', table_name='transaction')
+        online.cut_over('transaction', 'type', 'type_new')
+        online.create_index('ix_transaction_user_id_type_timestamp', 'transaction',
+                            ['user_id', 'type', 'timestamp'])
+"""
+import logging
+import time
+
+from alembic import op
+import sqlalchemy as sa
+
+
+logger = logging.getLogger('alembic.online')
+
+PROGRESS_TABLE = 'online_migration_progress'
+
+
+def _is_mysql(bind):
+    return bind.dialect.name in ('mysql', 'mariadb')
+
+
+def _progress_table():
+    return sa.table(
+        PROGRESS_TABLE,
+        sa.column('name', sa.String),
+        sa.column('last_id', sa.Integer),
+        sa.column('rows_done', sa.Integer),
+    )
+
+
+def _ensure_progress_table(bind):
+    # Lives outside the models on purpose, it only exists while migrating
+    table = sa.Table(
+        PROGRESS_TABLE, sa.MetaData(),
+        sa.Column('name', sa.String(100), primary_key=True),
+        sa.Column('last_id', sa.Integer, nullable=False),
+        sa.Column('rows_done', sa.Integer, nullable=False),
+    )
+    table.create(bind, checkfirst=True)
+
+
+def _load_progress(bind, name):
+    progress = _progress_table()
+    row = bind.execute(
+        sa.select(progress.c.last_id, progress.c.rows_done).where(progress.c.name == name)
+    ).first()
+    if row is None:
+        bind.execute(progress.insert().values(name=name, last_id=0, rows_done=0))
+        return 0, 0
+    return row.last_id, row.rows_done
+
+
+def _save_progress(bind, name, last_id, rows_done):
+    progress = _progress_table()
+    bind.execute(
+        progress.update()
+        .where(progress.c.name == name)
+        .values(last_id=last_id, rows_done=rows_done)
+    )
+
+
+def add_column(table_name, column):
+    """Add a nullable column without rebuilding the table."""
+    bind = op.get_bind()
+
+    if _is_mysql(bind):
+        # Ask MySQL to fail loudly rather than silently fall back to a table copy
+        ddl = sa.schema.CreateColumn(column).compile(dialect=bind.dialect)
+        op.execute(f'ALTER TABLE `{table_name}` ADD COLUMN {ddl}, ALGORITHM=INPLACE, LOCK=NONE')
+    else:
+        op.add_column(table_name, column)
+
+
+def create_index(index_name, table_name, columns, **kw):
+    """Create an index while still allowing reads and writes on the table."""
+    bind = op.get_bind()
+
+    if _is_mysql(bind):
+        cols = ', '.join(f'`{col}`' for col in columns)
+        op.execute(
+            f'CREATE INDEX `{index_name}` ON `{table_name}` ({cols}) ALGORITHM=INPLACE, LOCK=NONE'
+        )
+    elif bind.dialect.name == 'postgresql':
+        # CONCURRENTLY is not allowed inside a transaction block
+        with op.get_context().autocommit_block():
+            op.create_index(index_name, table_name, columns, postgresql_concurrently=True, **kw)
+    else:
+        op.create_index(index_name, table_name, columns, **kw)
+
+
+def backfill(table_name, values, name, where=None, pk='id',
+             chunk_size=5000, pause=0.1, report_every=50):
+    """Run an UPDATE over ``table_name`` in primary-key chunks.
+
+    ``values`` maps column names to the value or SQL expression to set.
+    Each chunk is committed on its own so row locks are only held briefly,
+    and ``pause`` seconds are slept between chunks to leave room for
+    application traffic. Progress is stored under ``name`` in the
+    ``online_migration_progress`` table; running the same backfill again
+    resumes after the last recorded chunk. The last chunk may be applied
+    twice after a crash, so ``values`` should be safe to re-run.
+
+    Build ``values`` and ``where`` from ``sa.column()`` rather than the
+    columns of another ``sa.table()``; the statement already names the
+    table and a second table object would be joined into the UPDATE.
+    """
+    context = op.get_context()
+
+    with context.autocommit_block():
+        bind = op.get_bind()
+        _ensure_progress_table(bind)
+        last_id, rows_done = _load_progress(bind, name)
+
+        table = sa.table(table_name, sa.column(pk), *(sa.column(col) for col in values))
+        id_col = table.c[pk]
+        max_id = bind.execute(sa.select(sa.func.max(id_col))).scalar() or 0
+
+        if last_id:
+            logger.info('Resuming backfill %s on %s after %s=%s', name, table_name, pk, last_id)
+
+        chunks = 0
+        started = time.monotonic()
+
+        while last_id < max_id:
+            upper = last_id + chunk_size
+
+            stmt = table.update().where(id_col > last_id, id_col <= upper).values(**values)
+            if where is not None:
+                stmt = stmt.where(where)
+
+            # Autocommit mode, so the chunk is committed as soon as it runs
+            result = bind.execute(stmt)
+            rows_done += result.rowcount
+            _save_progress(bind, name, upper, rows_done)
+
+            last_id = upper
+            chunks += 1
+
+            if chunks % report_every == 0 or last_id >= max_id:
+                elapsed = time.monotonic() - started
+                logger.info('Backfill %s: %s/%s ids done, %s rows updated, %.1fs elapsed',
+                            name, min(last_id, max_id), max_id, rows_done, elapsed)
+
+            if pause:
+                time.sleep(pause)
+
+        # Finished, forget the bookmark so a later downgrade/upgrade starts clean
+        progress = _progress_table()
+        bind.execute(progress.delete().where(progress.c.name == name))
+
+    return rows_done
+
+
+def _trigger_names(table_name, new_column):
+    return f'{table_name}_{new_column}_sync_ins', f'{table_name}_{new_column}_sync_upd'
+
+
+def sync_column(table_name, old_column, new_column, expression='{}', pk='id'):
+    """Install triggers that copy ``old_column`` into ``new_column`` on every write.
+
+    Call this before ``backfill()``: from then on every INSERT, and every
+    UPDATE of the old column, also sets the new one, so rows written while
+    the backfill runs (or changed after their chunk was copied) stay in
+    sync. ``expression`` is a SQL template where ``{}`` stands for the old
+    value, e.g. ``'UPPER({})'``; it should match what the backfill sets.
+    ``cut_over()`` removes the triggers again.
+    """
+    bind = op.get_bind()
+    quote = bind.dialect.identifier_preparer.quote
+    table, old, new, id_col = quote(table_name), quote(old_column), quote(new_column), quote(pk)
+    insert_trigger, update_trigger = (quote(name) for name in _trigger_names(table_name, new_column))
+    value = expression.format(f'NEW.{old}')
+
+    if _is_mysql(bind):
+        op.execute(f'CREATE TRIGGER {insert_trigger} BEFORE INSERT ON {table} '
+                   f'FOR EACH ROW SET NEW.{new} = {value}')
+        op.execute(f'CREATE TRIGGER {update_trigger} BEFORE UPDATE ON {table} '
+                   f'FOR EACH ROW SET NEW.{new} = {value}')
+    elif bind.dialect.name == 'postgresql':
+        function = quote(f'{table_name}_{new_column}_sync')
+        op.execute(f'CREATE FUNCTION {function}() RETURNS trigger AS $$ '
+                   f'BEGIN NEW.{new} := {value}; RETURN NEW; END $$ LANGUAGE plpgsql')
+        op.execute(f'CREATE TRIGGER {insert_trigger} BEFORE INSERT ON {table} '
+                   f'FOR EACH ROW EXECUTE FUNCTION {function}()')
+        op.execute(f'CREATE TRIGGER {update_trigger} BEFORE UPDATE OF {old} ON {table} '
+                   f'FOR EACH ROW EXECUTE FUNCTION {function}()')
+    else:
+        # SQLite can't assign to NEW, so the row is updated right after the write
+        op.execute(f'CREATE TRIGGER {insert_trigger} AFTER INSERT ON {table} '
+                   f'BEGIN UPDATE {table} SET {new} = {value} WHERE {id_col} = NEW.{id_col}; END')
+        op.execute(f'CREATE TRIGGER {update_trigger} AFTER UPDATE OF {old} ON {table} '
+                   f'BEGIN UPDATE {table} SET {new} = {value} WHERE {id_col} = NEW.{id_col}; END')
+
+
+def _drop_sync(bind, table_name, new_column):
+    quote = bind.dialect.identifier_preparer.quote
+    on_table = f' ON {quote(table_name)}' if bind.dialect.name == 'postgresql' else ''
+
+    for name in _trigger_names(table_name, new_column):
+        op.execute(f'DROP TRIGGER {quote(name)}{on_table}')
+    if bind.dialect.name == 'postgresql':
+        op.execute(f'DROP FUNCTION {quote(f"{table_name}_{new_column}_sync")}()')
+
+
+def cut_over(table_name, old_column, new_column):
+    """Swap ``new_column`` in for ``old_column`` once it has been backfilled.
+
+    The table is write-locked just long enough to drop the ``sync_column()``
+    triggers and rename the two columns, so no write can land in between;
+    renames only touch metadata. The old column is then dropped under its
+    retired name. On PostgreSQL and SQLite the lock is held until the
+    migration's transaction commits, so keep whatever follows this call in
+    the same revision short.
+
+    Indexes that include the old column must be dropped before calling
+    this and recreated on the renamed column afterwards: SQLite refuses to
+    drop an indexed column, PostgreSQL drops such indexes with it and MySQL
+    silently removes the column from them.
+    """
+    bind = op.get_bind()
+    quote = bind.dialect.identifier_preparer.quote
+    retired = f'_{old_column}_retired'
+
+    if _is_mysql(bind):
+        table = quote(table_name)
+        op.execute(f'LOCK TABLES {table} WRITE')
+        try:
+            _drop_sync(bind, table_name, new_column)
+            op.execute(f'ALTER TABLE {table} RENAME COLUMN {quote(old_column)} TO {quote(retired)}, '
+                       f'RENAME COLUMN {quote(new_column)} TO {quote(old_column)}')
+        finally:
+            op.execute('UNLOCK TABLES')
+        op.execute(f'ALTER TABLE {table} DROP COLUMN {quote(retired)}, ALGORITHM=INPLACE, LOCK=NONE')
+        return
+
+    if bind.dialect.name == 'postgresql':
+        op.execute(f'LOCK TABLE {quote(table_name)} IN ACCESS EXCLUSIVE MODE')
+    else:
+        # SQLite only starts its transaction at the first write, so write
+        # something to take the database lock before the DDL below
+        _ensure_progress_table(bind)
+        progress = _progress_table()
+        bind.execute(progress.insert().values(name=f'{table_name}_cut_over', last_id=0, rows_done=0))
+        bind.execute(progress.delete().where(progress.c.name == f'{table_name}_cut_over'))
+
+    _drop_sync(bind, table_name, new_column)
+    op.alter_column(table_name, old_column, new_column_name=retired)
+    op.alter_column(table_name, new_column, new_column_name=old_column)
+    op.drop_column(table_name, retired)
@@ -0,0 +1,41 @@
+"""add transaction search indexes
+
+Revision ID: 5b1d2c7e9a40
+Revises: ec2e35679b94
+Create Date: 2026-10-19 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migrations import online
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1d2c7e9a40'
+down_revision = 'ec2e35679b94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built online so the transaction table stays writable while they are created
+    online.create_index('ix_transaction_user_id_timestamp', 'transaction', ['user_id', 'timestamp'])
+    online.create_index('ix_transaction_user_id_type_timestamp', 'transaction', ['user_id', 'type', 'timestamp'])
+    online.create_index('ix_transaction_user_id_recipient_card_number', 'transaction', ['user_id', 'recipient_card_number'])
+    # Name search is a case-insensitive prefix match. PostgreSQL's LIKE is case-sensitive,
+    # so it indexes lower(recipient_name), with text_pattern_ops so LIKE 'prefix%' can
+    # use it under any collation (see fold_case in app.py)
+    if op.get_bind().dialect.name == 'postgresql':
+        name_columns = ['user_id', sa.text('lower(recipient_name) text_pattern_ops')]
+    else:
+        name_columns = ['user_id', 'recipient_name']
+    online.create_index('ix_transaction_user_id_recipient_name', 'transaction', name_columns)
+
+
+def downgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_index('ix_transaction_user_id_recipient_name')
+        batch_op.drop_index('ix_transaction_user_id_recipient_card_number')
+        batch_op.drop_index('ix_transaction_user_id_type_timestamp')
+        batch_op.drop_index('ix_transaction_user_id_timestamp')
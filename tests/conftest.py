@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Must be set before app.py is imported; load_dotenv() doesn't override it.
+# A file rather than :memory: so separate connections see the same data.
+os.environ['DB_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bank.db')
+
+
+@pytest.fixture
+def app():
+    from app import app, db
+
+    app.config['TESTING'] = True
+    app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+        # Fresh connections for the next test, SQLite only reads planner statistics when it connects
+        db.engine.dispose()
@@ -0,0 +1,295 @@
+import socket
+import threading
+import time
+import uuid
+
+import pytest
+import requests
+from sqlalchemy import create_engine, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.serving import make_server
+
+import airtime
+import airtime_stub
+from app import db, AirtimePurchase, Transaction, User
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    # The stand-in provider on a free local port, with no latency or failures by default
+    for name in ('LATENCY', 'JITTER', 'FAILURE_RATE', 'TIMEOUT_RATE', 'DECLINE_RATE'):
+        monkeypatch.setattr(airtime_stub, name, 0)
+    airtime_stub.results.clear()
+
+    server = make_server('127.0.0.1', 0, airtime_stub.stub, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def queued(monkeypatch):
+    # Collect what recharge() queues instead of starting the flusher thread,
+    # which would otherwise keep running (and holding a connection) after the test
+    ids = []
+    monkeypatch.setattr(airtime, 'queue_purchase', ids.append)
+    return ids
+
+
+@pytest.fixture
+def elsewhere(app):
+    # Another process writing to the same database, outside the app's connection pool
+    engine = create_engine(db.engine.url)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def client(stub, monkeypatch):
+    provider = airtime.AirtimeClient(stub, connect_timeout=0.5, read_timeout=0.5,
+                                     failure_threshold=3, reset_timeout=60)
+    monkeypatch.setattr(airtime, '_client', provider)
+    return provider
+
+
+@pytest.fixture
+def purchases(app):
+    def make(count=1, amount=1000):
+        user = User.query.first()
+        if user is None:
+            user = User(full_name='Owner', email='owner@example.com', password='x',
+                        card_number='1' * 16, balance=50000)
+            db.session.add(user)
+            db.session.commit()
+        made = []
+        for _ in range(count):
+            # What recharge() records: a 10% discounted debit plus the pending purchase
+            user.balance = User.balance - amount * 0.9
+            transaction = Transaction(user=user, amount=-amount * 0.9, type='Debit - Airtime Purchase')
+            made.append(AirtimePurchase(user=user, transaction=transaction, phone_number='08111291141',
+                                        amount=amount, reference=str(uuid.uuid4())))
+            db.session.add(made[-1])
+            db.session.commit()
+        return made
+    return make
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_deliver_sends_one_bulk_call(client, purchases):
+    made = purchases(3)
+
+    assert airtime.deliver([purchase.id for purchase in made]) == 3
+
+    assert {purchase.status for purchase in made} == {'delivered'}
+    assert all(purchase.provider_reference for purchase in made)
+    assert set(airtime_stub.results) == {purchase.reference for purchase in made}
+
+
+def test_declined_topup_is_refunded(client, purchases):
+    airtime_stub.DECLINE_RATE = 1
+    purchase, = purchases()
+
+    assert airtime.deliver([purchase.id]) == 1
+
+    assert purchase.status == 'failed'
+    assert db.session.get(User, purchase.user_id).balance == 50000
+    assert Transaction.query.filter_by(type='Credit - Airtime Refund').one().amount == 900
+
+
+def test_refund_keeps_concurrent_balance_change(client, purchases, elsewhere):
+    airtime_stub.DECLINE_RATE = 1
+    purchase, = purchases()
+    assert purchase.user.balance == 49100
+
+    # A deposit commits from another connection after the user was loaded here
+    with elsewhere.begin() as conn:
+        conn.execute(update(User).where(User.id == purchase.user_id).values(balance=User.balance + 500))
+    airtime.deliver([purchase.id])
+
+    db.session.expire_all()
+    assert db.session.get(User, purchase.user_id).balance == 50500
+
+
+def test_rejected_purchase_is_refunded_without_holding_up_the_batch(client, purchases):
+    made = purchases(3)
+    made[1].phone_number = '123'
+    db.session.commit()
+
+    assert airtime.deliver([purchase.id for purchase in made]) == 3
+
+    assert [purchase.status for purchase in made] == ['delivered', 'failed', 'delivered']
+    assert [purchase.attempts for purchase in made] == [1, 1, 1]
+    refund = Transaction.query.filter_by(type='Credit - Airtime Refund').one()
+    assert refund.amount == 900
+    assert db.session.get(User, made[0].user_id).balance == 50000 - 2 * 900
+
+
+def test_purchase_is_refunded_after_max_attempts(client, purchases):
+    purchase, = purchases()
+    purchase.status = 'submitted'
+    purchase.attempts = 5
+    db.session.commit()
+
+    # The provider still has no record of it, so it is given up on instead of sent a sixth time
+    assert airtime.reconcile(stale_after=0) == 1
+
+    assert purchase.status == 'failed'
+    assert purchase.reference not in airtime_stub.results
+    assert db.session.get(User, purchase.user_id).balance == 50000
+
+
+def test_concurrent_reconcilers_refund_once(purchases, elsewhere):
+    purchase, = purchases()
+    purchase.status = 'submitted'
+    db.session.commit()
+    assert purchase.status == 'submitted'
+
+    # Another reconciler settles and refunds it after this one loaded it
+    with elsewhere.begin() as conn:
+        conn.execute(update(AirtimePurchase).where(AirtimePurchase.id == purchase.id).values(status='failed'))
+
+    assert airtime._apply_results([purchase], [{'reference': purchase.reference, 'status': 'failed'}]) == 0
+    assert Transaction.query.filter_by(type='Credit - Airtime Refund').count() == 0
+    assert db.session.get(User, purchase.user_id).balance == 49100
+
+
+def test_refused_connection_puts_purchases_back(app, purchases, monkeypatch):
+    monkeypatch.setattr(airtime, '_client', airtime.AirtimeClient(f'http://127.0.0.1:{closed_port()}'))
+    purchase, = purchases()
+
+    assert airtime.deliver([purchase.id]) == 0
+
+    assert purchase.status == 'pending'
+    assert purchase.attempts == 0
+
+
+def test_read_timeout_is_settled_by_reconcile(client, purchases):
+    # The provider handles the top-up but answers after the client gave up
+    airtime_stub.LATENCY = 1
+    purchase, = purchases()
+
+    assert airtime.deliver([purchase.id]) == 0
+    assert purchase.status == 'submitted'
+
+    airtime_stub.LATENCY = 0
+    time.sleep(1)
+    assert airtime.reconcile(stale_after=0) == 1
+    assert purchase.status == 'delivered'
+
+
+def test_reconcile_resends_purchases_the_provider_never_saw(client, purchases):
+    purchase, = purchases()
+    purchase.status = 'submitted'
+    db.session.commit()
+
+    # The status check moves it back to pending and the same pass sends it again
+    assert airtime.reconcile(stale_after=0) == 1
+    assert purchase.status == 'delivered'
+    assert purchase.reference in airtime_stub.results
+
+
+def test_breaker_opens_after_repeated_failures(client, purchases):
+    airtime_stub.FAILURE_RATE = 1
+    made = purchases(4)
+
+    for purchase in made[:3]:
+        airtime.deliver([purchase.id])
+    assert client.breaker.state == 'open'
+
+    # Refused without a call, so the purchase goes straight back to pending
+    assert airtime.deliver([made[3].id]) == 0
+    assert made[3].status == 'pending'
+    assert [purchase.status for purchase in made[:3]] == ['submitted'] * 3
+
+
+def test_full_bulkhead_leaves_the_breaker_open(stub):
+    provider = airtime.AirtimeClient(stub, max_concurrent=1, failure_threshold=1, reset_timeout=0)
+    provider.breaker.record_failure()
+
+    # The trial call can't get a slot, so the breaker must not move to half_open
+    with provider.bulkhead:
+        with pytest.raises(airtime.ProviderUnavailable, match='concurrent'):
+            provider.status(['ref'])
+    assert provider.breaker.state == 'open'
+
+    provider.status(['ref'])
+    assert provider.breaker.state == 'closed'
+
+
+def test_malformed_response_is_a_provider_error(client, monkeypatch):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'<html>maintenance</html>'
+    monkeypatch.setattr(client.session, 'post', lambda *args, **kwargs: response)
+
+    with pytest.raises(airtime.ProviderError) as info:
+        client.status(['ref'])
+    assert not isinstance(info.value, airtime.ProviderUnavailable)
+
+
+def test_bulkhead_rejects_when_full():
+    bulkhead = airtime.Bulkhead(max_concurrent=1, acquire_timeout=0.01)
+
+    with bulkhead:
+        with pytest.raises(airtime.ProviderUnavailable):
+            with bulkhead:
+                pass
+
+
+@pytest.mark.parametrize('phone_number, amount', [('', '1000'), ('12', '1000'), ('0811 129 1141', '-5')])
+def test_recharge_rejects_invalid_topups(app, phone_number, amount):
+    db.session.add(User(full_name='Owner', email='owner@example.com', password='x',
+                        card_number='1' * 16, balance=50000))
+    db.session.commit()
+    web = app.test_client()
+    with web.session_transaction() as session:
+        session['user_id'] = 1
+
+    response = web.post('/recharge', data={'card_number': phone_number, 'amount': amount})
+
+    assert response.status_code == 302
+    assert AirtimePurchase.query.count() == 0
+    assert db.session.get(User, 1).balance == 50000
+
+
+def test_recharge_keeps_the_money_if_the_purchase_cannot_be_stored(app, purchases, monkeypatch):
+    existing, = purchases()
+    monkeypatch.setattr('app.uuid.uuid4', lambda: existing.reference)
+    web = app.test_client()
+    with web.session_transaction() as session:
+        session['user_id'] = existing.user_id
+
+    # The purchase clashes on its reference, the debit must roll back with it
+    with pytest.raises(IntegrityError):
+        web.post('/recharge', data={'card_number': '0811 129 1141', 'amount': '1000'})
+
+    db.session.rollback()
+    assert db.session.get(User, existing.user_id).balance == 49100
+    assert AirtimePurchase.query.count() == 1
+
+
+def test_recharge_queues_the_purchase_for_delivery(app, client, queued):
+    db.session.add(User(full_name='Owner', email='owner@example.com', password='x',
+                        card_number='1' * 16, balance=50000))
+    db.session.commit()
+    web = app.test_client()
+    with web.session_transaction() as session:
+        session['user_id'] = 1
+
+    response = web.post('/recharge', data={'card_number': '0811 129 1141', 'amount': '1000'})
+
+    assert response.status_code == 200
+    purchase = AirtimePurchase.query.one()
+    assert purchase.phone_number == '08111291141'
+    assert queued == [purchase.id]
+
+    # What the flusher thread does with the queued batch
+    assert airtime.deliver(queued) == 1
+    assert purchase.status == 'delivered'
+    assert db.session.get(User, 1).balance == 49100
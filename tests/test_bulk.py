@@ -0,0 +1,133 @@
+import csv
+import json
+
+import pytest
+import sqlalchemy as sa
+
+import bulk
+from app import bcrypt, db, User, Transaction
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as handle:
+        writer = csv.DictWriter(handle, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_import_users_hashes_passwords_and_assigns_cards(app, tmp_path):
+    path = write_csv(tmp_path / 'users.csv', [
+        {'full_name': f'User {i}', 'email': f'user{i}@example.com', 'password': f'secret{i}'}
+        for i in range(20)
+    ])
+
+    result = app.test_cli_runner().invoke(args=['bulk', 'import-users', path, '--batch-size', '7'])
+
+    assert result.exit_code == 0, result.output
+    users = User.query.order_by(User.id).all()
+    assert len(users) == 20
+    assert bcrypt.check_password_hash(users[3].password, 'secret3')
+    assert len({user.card_number for user in users}) == 20
+    assert all(len(user.card_number) == 16 for user in users)
+
+
+def test_import_users_rejects_duplicate_emails(app, tmp_path):
+    db.session.add(User(full_name='Existing', email='taken@example.com', password='x', card_number='1' * 16))
+    db.session.commit()
+    path = write_csv(tmp_path / 'users.csv', [
+        {'full_name': 'New', 'email': 'new@example.com', 'password': 'secret'},
+        {'full_name': 'Clash', 'email': 'taken@example.com', 'password': 'secret'},
+    ])
+
+    result = app.test_cli_runner().invoke(args=['bulk', 'import-users', path])
+
+    assert result.exit_code != 0
+    assert 'Duplicate emails: taken@example.com' in result.output
+    assert User.query.count() == 1
+
+
+@pytest.fixture
+def transactions_file(app, tmp_path):
+    db.session.add(User(full_name='Owner', email='owner@example.com', password='x', card_number='2' * 16))
+    db.session.commit()
+    path = tmp_path / 'transactions.ndjson'
+    path.write_text(''.join(
+        json.dumps({'user_email': 'owner@example.com', 'recipient_name': 'Someone',
+                    'recipient_card_number': '3' * 16, 'amount': i, 'type': 'Debit',
+                    'timestamp': f'2026-01-{i % 28 + 1:02d}T10:00:00'}) + '\n'
+        for i in range(50)
+    ))
+    return str(path)
+
+
+def index_names():
+    return {index['name'] for index in sa.inspect(db.engine).get_indexes('transaction')}
+
+
+def test_import_transactions_keeps_indexes_by_default(app, transactions_file):
+    result = app.test_cli_runner().invoke(args=['bulk', 'import-transactions', transactions_file])
+
+    assert result.exit_code == 0, result.output
+    assert 'Rebuilding index' not in result.output
+    assert Transaction.query.count() == 50
+
+
+def test_import_transactions_rebuilds_deferred_indexes(app, transactions_file):
+    result = app.test_cli_runner().invoke(
+        args=['bulk', 'import-transactions', transactions_file, '--batch-size', '20', '--defer-indexes']
+    )
+
+    assert result.exit_code == 0, result.output
+    assert 'Rebuilding index' in result.output
+    assert Transaction.query.count() == 50
+    assert {index.name for index in Transaction.__table__.indexes} <= index_names()
+
+
+def test_failed_drop_rebuilds_the_indexes_already_dropped(app, transactions_file, monkeypatch):
+    last = bulk._deferrable_indexes(Transaction, 'sqlite')[-1]
+    drop = sa.Index.drop
+
+    def failing_drop(index, *args, **kwargs):
+        if index is last:
+            raise sa.exc.OperationalError('DROP INDEX', {}, Exception('needed in a foreign key constraint'))
+        drop(index, *args, **kwargs)
+
+    monkeypatch.setattr(sa.Index, 'drop', failing_drop)
+    result = app.test_cli_runner().invoke(args=['bulk', 'import-transactions', transactions_file, '--defer-indexes'])
+
+    assert result.exit_code != 0
+    assert {index.name for index in Transaction.__table__.indexes} <= index_names()
+
+
+def test_mysql_keeps_an_index_for_each_foreign_key():
+    everywhere = bulk._deferrable_indexes(Transaction, 'sqlite')
+    mysql = bulk._deferrable_indexes(Transaction, 'mysql')
+
+    assert len(mysql) == len(everywhere) - 1
+    kept, = set(everywhere) - set(mysql)
+    assert [column.key for column in kept.columns][0] == 'user_id'
+
+
+def test_import_transactions_rejects_unknown_owner(app, tmp_path):
+    path = write_csv(tmp_path / 'transactions.csv', [{'user_id': '42', 'amount': '10', 'type': 'Debit'}])
+
+    result = app.test_cli_runner().invoke(args=['bulk', 'import-transactions', path])
+
+    assert result.exit_code != 0
+    assert 'Unknown user ids: 42' in result.output
+    assert Transaction.query.count() == 0
+
+
+def test_export_streams_every_row(app, tmp_path):
+    db.session.add(User(full_name='Owner', email='owner@example.com', password='x', card_number='2' * 16))
+    db.session.add_all([Transaction(user_id=1, amount=i, type='Credit') for i in range(30)])
+    db.session.commit()
+    path = tmp_path / 'out.csv'
+
+    result = app.test_cli_runner().invoke(args=['bulk', 'export', 'transactions', str(path), '--batch-size', '8'])
+
+    assert result.exit_code == 0, result.output
+    with open(path, newline='') as handle:
+        rows = list(csv.DictReader(handle))
+    assert [float(row['amount']) for row in rows] == list(range(30))
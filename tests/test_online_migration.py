@@ -0,0 +1,144 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+import pytest
+import sqlalchemy as sa
+
+from migrations import online
+
+
+ROWS = int(os.environ.get('ONLINE_MIGRATION_ROWS', 2_000_000))
+
+
+def expected_type(row_id):
+    return f't{row_id % 4}'
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = tmp_path / 'bank.db'
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE "transaction" (id INTEGER PRIMARY KEY, amount FLOAT, type VARCHAR(10))')
+    conn.executemany(
+        'INSERT INTO "transaction" (id, amount, type) VALUES (?, ?, ?)',
+        ((i, float(i), expected_type(i)) for i in range(1, ROWS + 1))
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def migrate(path, steps):
+    engine = sa.create_engine(f'sqlite:///{path}', connect_args={'timeout': 60})
+    with engine.connect() as conn:
+        context = MigrationContext.configure(conn)
+        # The per-migration transaction alembic opens around each revision on SQLite
+        with Operations.context(context), context.begin_transaction(_per_migration=True):
+            steps()
+    engine.dispose()
+
+
+class Writer(threading.Thread):
+    # Application stand-in: inserts new rows and changes the type of existing ones
+
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.stop = threading.Event()
+        self.expected = {}
+        self.write_times = []
+        self.errors = []
+
+    def run(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        rng = random.Random(0)
+        n = 0
+        while not self.stop.is_set():
+            n += 1
+            try:
+                if n % 2:
+                    cursor = conn.execute('INSERT INTO "transaction" (amount, type) VALUES (?, ?)', (1.0, f'i{n}'))
+                    self.expected[cursor.lastrowid] = f'i{n}'
+                else:
+                    row_id = rng.randint(1, ROWS)
+                    conn.execute('UPDATE "transaction" SET type = ? WHERE id = ?', (f'u{n}', row_id))
+                    self.expected[row_id] = f'u{n}'
+            except sqlite3.Error as exc:
+                self.errors.append(exc)
+            self.write_times.append(time.monotonic())
+            time.sleep(0.001)
+        conn.close()
+
+
+def test_column_swap_keeps_writes_flowing(database):
+    writer = Writer(database)
+    marks = {}
+
+    def steps():
+        online.add_column('transaction', sa.Column('type_new', sa.String(25)))
+        online.sync_column('transaction', 'type', 'type_new')
+        marks['backfill'] = time.monotonic()
+        online.backfill('transaction', {'type_new': sa.column('type')}, name='widen_type', pause=0.001)
+        marks['cut_over'] = time.monotonic()
+        online.cut_over('transaction', 'type', 'type_new')
+
+    writer.start()
+    try:
+        migrate(database, steps)
+        # A few more writes against the swapped column
+        time.sleep(0.2)
+    finally:
+        writer.stop.set()
+        writer.join()
+
+    assert writer.errors == []
+    during_backfill = [t for t in writer.write_times if marks['backfill'] <= t < marks['cut_over']]
+    assert len(during_backfill) > 10
+
+    conn = sqlite3.connect(database)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info("transaction")')]
+    assert columns == ['id', 'amount', 'type']
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'").fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM online_migration_progress').fetchone()[0] == 0
+
+    wrong = [
+        (row_id, value) for row_id, value in conn.execute('SELECT id, type FROM "transaction"')
+        if value != writer.expected.get(row_id, expected_type(row_id))
+    ]
+    assert wrong == []
+    assert conn.execute('SELECT COUNT(*) FROM "transaction"').fetchone()[0] == ROWS + sum(
+        1 for value in writer.expected.values() if value.startswith('i')
+    )
+    conn.close()
+
+
+def test_backfill_resumes_after_last_chunk(tmp_path):
+    path = tmp_path / 'bank.db'
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE "transaction" (id INTEGER PRIMARY KEY, type VARCHAR(10), type_new VARCHAR(25))')
+    conn.executemany('INSERT INTO "transaction" (id, type) VALUES (?, ?)', ((i, 'x') for i in range(1, 1001)))
+    # An earlier run got as far as id 600 before it was interrupted
+    conn.execute('CREATE TABLE online_migration_progress (name VARCHAR(100) PRIMARY KEY, '
+                 'last_id INTEGER NOT NULL, rows_done INTEGER NOT NULL)')
+    conn.execute("INSERT INTO online_migration_progress VALUES ('resume', 600, 600)")
+    conn.commit()
+    conn.close()
+
+    result = {}
+
+    def steps():
+        result['rows'] = online.backfill('transaction', {'type_new': sa.column('type')},
+                                         name='resume', chunk_size=100, pause=0)
+
+    migrate(path, steps)
+
+    conn = sqlite3.connect(path)
+    assert result['rows'] == 1000
+    assert conn.execute('SELECT MIN(id) FROM "transaction" WHERE type_new IS NOT NULL').fetchone()[0] == 601
+    assert conn.execute('SELECT COUNT(*) FROM online_migration_progress').fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,116 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.schema import CreateIndex
+
+from app import db, User, Transaction, TransactionSearch, transaction_rows_query
+
+
+@pytest.fixture
+def transactions(app):
+    # Enough spread over users, cards and types for the planner statistics to be realistic
+    rng = random.Random(0)
+    db.session.execute(Transaction.__table__.insert(), [
+        {
+            'user_id': rng.randint(1, 20),
+            'recipient_name': f'Name {rng.randint(0, 500)}',
+            'recipient_card_number': str(rng.randint(10 ** 15, 10 ** 16 - 1)),
+            'amount': rng.uniform(1, 1000),
+            'type': rng.choice(['Debit', 'Credit', 'Credit - Deposit']),
+            'timestamp': datetime(2026, 1, 1) + timedelta(hours=i),
+        }
+        for i in range(20000)
+    ])
+    db.session.commit()
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+
+
+def query_plan(search):
+    conn = db.session.connection()
+    compiled = transaction_rows_query(1, search).compile(conn)
+    params = tuple(compiled.params[key] for key in compiled.positiontup)
+    return [row[3] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params)]
+
+
+@pytest.mark.parametrize('search, index', [
+    (TransactionSearch(), 'ix_transaction_user_id_timestamp'),
+    (TransactionSearch(type='Debit'), 'ix_transaction_user_id_type_timestamp'),
+    (TransactionSearch(type='Debit', date_from=datetime(2026, 1, 1), date_to=datetime(2026, 2, 1)),
+     'ix_transaction_user_id_type_timestamp'),
+    (TransactionSearch(card_number='1234567812345678'), 'ix_transaction_user_id_recipient_card_number'),
+    (TransactionSearch(min_amount=10, max_amount=500), 'ix_transaction_user_id_timestamp'),
+])
+def test_search_uses_index(transactions, search, index):
+    plan = query_plan(search)
+
+    assert not any(step.startswith('SCAN') for step in plan), plan
+    assert plan[0].startswith(f'SEARCH transaction USING INDEX {index} '), plan
+
+
+def test_name_prefix_uses_index(transactions):
+    # SQLite's LIKE is case-insensitive by default and can't use a plain index then;
+    # MySQL's case-insensitive collations can, which this pragma stands in for
+    conn = db.session.connection()
+    conn.exec_driver_sql('PRAGMA case_sensitive_like=ON')
+    try:
+        plan = query_plan(TransactionSearch(name='Name 4'))
+    finally:
+        conn.exec_driver_sql('PRAGMA case_sensitive_like=OFF')
+
+    assert plan[0].startswith('SEARCH transaction USING INDEX ix_transaction_user_id_recipient_name '), plan
+    assert 'recipient_name>?' in plan[0]
+
+
+def test_name_prefix_is_a_literal_pattern_on_mysql():
+    compiled = transaction_rows_query(1, TransactionSearch(name='50%_a/b')).compile(dialect=mysql.dialect())
+
+    assert "recipient_name LIKE %s ESCAPE '/'" in str(compiled)
+    assert 'concat' not in str(compiled).lower()
+    assert compiled.params['param_1'] == '50/%/_a//b%'
+
+
+def test_name_prefix_ignores_case_on_postgresql():
+    # PostgreSQL's LIKE is case-sensitive, so both sides and the index are lower-cased
+    compiled = transaction_rows_query(1, TransactionSearch(name='john')).compile(dialect=postgresql.dialect())
+    index, = (index for index in Transaction.__table__.indexes if index.name == 'ix_transaction_user_id_recipient_name')
+
+    assert "lower(transaction.recipient_name) LIKE lower(%(param_1)s) ESCAPE '/'" in str(compiled)
+    assert str(CreateIndex(index).compile(dialect=postgresql.dialect())).endswith(
+        '(user_id, lower(recipient_name) text_pattern_ops)')
+
+
+def test_from_args_ignores_empty_and_malformed_values():
+    search = TransactionSearch.from_args({
+        'name': ' Jo ', 'card_number': '1234-5678 1234 5678', 'type': '',
+        'min_amount': 'lots', 'max_amount': '99.5', 'date_from': '2026-13-01', 'date_to': '2026-02-01',
+    })
+
+    assert search == TransactionSearch(name='Jo', card_number='1234567812345678', max_amount=99.5,
+                                       date_to=datetime(2026, 2, 1))
+
+
+def test_history_filters_and_paginates(app):
+    db.session.add(User(full_name='Owner', email='owner@example.com', password='x', card_number='1' * 16))
+    db.session.add_all([
+        Transaction(user_id=1, recipient_card_number=f'{i:016d}', amount=i,
+                    type='Debit' if i % 2 else 'Credit', timestamp=datetime(2026, 1, 1) + timedelta(hours=i))
+        for i in range(120)
+    ])
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+
+    first = client.get('/transaction_history?type=Debit')
+    second = client.get('/transaction_history?type=Debit&page=2')
+
+    assert first.status_code == second.status_code == 200
+    assert first.data.count(b'<td>Debit</td>') == 50
+    assert b'page=2&amp;type=Debit' in first.data or b'type=Debit&amp;page=2' in first.data
+    assert second.data.count(b'<td>Debit</td>') == 10
+    assert b'Credit</td>' not in second.data
+    assert b'Next</a>' not in second.data